@@ -1,11 +1,25 @@
-from flask import Flask, render_template, request, redirect
+from flask import (
+    Flask, Response, render_template, request, redirect, abort, g, jsonify, send_from_directory,
+    has_app_context, before_render_template, template_rendered,
+)
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+import functools
 import hashlib
+import json
+import mimetypes
 import os
+import queue
+import select
+import threading
+import time
 
 # DB imports (both)
 import sqlite3
 import psycopg2
 import psycopg2.extras
+from werkzeug.security import safe_join
 
 app = Flask(__name__)
 
@@ -14,19 +28,483 @@ app = Flask(__name__)
 # -----------------------------
 USE_POSTGRES = "DATABASE_URL" in os.environ
 
-def get_db():
+# Pool sizing is per gunicorn worker
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = float(os.environ.get("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PING_AFTER = float(os.environ.get("DB_POOL_PING_AFTER", "30"))
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+def connect_db():
     if USE_POSTGRES:
-        conn = psycopg2.connect(os.environ["DATABASE_URL"])
+        return psycopg2.connect(os.environ["DATABASE_URL"])
+    conn = sqlite3.connect("database.db", check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """Bounded pool of open connections, handed out LIFO.
+
+    Idle connections are pinged before reuse once they have sat for
+    `ping_after` seconds, and replaced once they are `recycle` seconds old.
+    """
+
+    def __init__(self, connect, size, timeout, recycle, ping_after):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._idle = []  # (conn, last_used)
+        self._born = {}
+        self._in_use = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.opened = 0
+        self.recycled = 0
+
+    def acquire(self):
+        with self._cond:
+            if self.pid != os.getpid():
+                # Forked after the parent opened connections; never share them
+                self._reset()
+            started = None
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._in_use < self.size:
+                    conn = last_used = None
+                    break
+                now = time.monotonic()
+                if started is None:
+                    started = now
+                    self.waits += 1
+                remaining = self.timeout - (now - started)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    self.wait_time += now - started
+                    raise PoolTimeout(f"no database connection free after {self.timeout}s")
+                self._cond.wait(remaining)
+            self._in_use += 1
+            if started is not None:
+                self.wait_time += time.monotonic() - started
+
+        try:
+            if conn is not None:
+                conn = self._check(conn, last_used)
+            if conn is None:
+                conn = self._open()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
         return conn
-    else:
-        conn = sqlite3.connect("database.db")
-        conn.row_factory = sqlite3.Row
+
+    def release(self, conn):
+        try:
+            conn.rollback()
+            healthy = not getattr(conn, "closed", False)
+        except Exception:
+            healthy = False
+        with self._cond:
+            self._in_use -= 1
+            if healthy:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if not healthy:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        # For work outside a request (e.g. streaming responses)
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def _open(self):
+        conn = self.connect()
+        with self._cond:
+            self._born[conn] = time.monotonic()
+            self.opened += 1
         return conn
 
-def init_db():
-    db = get_db()
-    cur = db.cursor()
+    def _check(self, conn, last_used):
+        now = time.monotonic()
+        if now - self._born.get(conn, now) > self.recycle:
+            self._discard(conn)
+            self.recycled += 1
+            return None
+        if now - last_used > self.ping_after:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return None
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._born.pop(conn, None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waits": self.waits,
+                "wait_time": round(self.wait_time, 6),
+                "timeouts": self.timeouts,
+                "opened": self.opened,
+                "recycled": self.recycled,
+            }
+
+pool = ConnectionPool(connect_db, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PING_AFTER)
+
+def get_db():
+    # One pooled connection per request, returned on teardown
+    if "db" not in g:
+        started = time.perf_counter()
+        g.db = pool.acquire()
+        record_timing("connect", time.perf_counter() - started)
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    db = g.pop("db", None)
+    if db is not None:
+        pool.release(db)
+
+# -----------------------------
+# Instrumentation
+# -----------------------------
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "100"))
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "") == "1"
+
+METRICS_PATH = os.environ.get("METRICS_PATH", "metrics.db")
+METRICS_FLUSH_INTERVAL = 5
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+class Histogram:
+    """Prometheus-style histogram with one series per route."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}  # route -> [bucket counts, sum, count]
+
+    def observe(self, route, value):
+        with self._lock:
+            series = self._series.setdefault(route, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {route: [list(counts), total, count] for route, (counts, total, count) in self._series.items()}
+
+    def merge(self, snapshots):
+        merged = {}
+        for snapshot in snapshots:
+            for route, (counts, total, count) in snapshot.items():
+                series = merged.setdefault(route, [[0] * len(self.buckets), 0.0, 0])
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+                series[2] += count
+        return merged
+
+    def render(self, series):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for route, (counts, total, count) in sorted(series.items()):
+            for bound, n in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{route="{route}",le="{bound}"}} {n}')
+            lines.append(f'{self.name}_bucket{{route="{route}",le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{route="{route}"}} {total}')
+            lines.append(f'{self.name}_count{{route="{route}"}} {count}')
+        return lines
+
+REQUEST_HISTOGRAMS = {
+    "total": Histogram("blip1t_request_duration_seconds", "Time to produce a response.", LATENCY_BUCKETS),
+    "db": Histogram("blip1t_request_db_seconds", "Time spent in queries per request.", LATENCY_BUCKETS),
+    "connect": Histogram("blip1t_request_connect_seconds", "Time spent checking out a connection per request.", LATENCY_BUCKETS),
+    "write": Histogram("blip1t_request_write_seconds", "Time spent waiting on group commits per request.", LATENCY_BUCKETS),
+    "render": Histogram("blip1t_request_render_seconds", "Time spent rendering templates per request.", LATENCY_BUCKETS),
+    "queries": Histogram("blip1t_request_queries", "Queries run per request.", QUERY_COUNT_BUCKETS),
+}
+slow_queries = 0
+
+def record_timing(kind, elapsed):
+    if has_app_context() and "timings" in g:
+        g.timings[kind] += elapsed
+
+def param_shape(params):
+    # Types only, never values; runs collapse so IN (...) lists stay short
+    if params is None:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in params.items()) + "}"
+    shape = []
+    for param in params:
+        name = type(param).__name__
+        if shape and shape[-1][0] == name:
+            shape[-1][1] += 1
+        else:
+            shape.append([name, 1])
+    return "(" + ", ".join(name if n == 1 else f"{name} x{n}" for name, n in shape) + ")"
+
+def record_query(sql, params, elapsed):
+    global slow_queries
+    if has_app_context() and "timings" in g:
+        g.timings["db"] += elapsed
+        g.query_count += 1
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_queries += 1
+        app.logger.warning(
+            "slow query (%.1f ms): %s params=%s", elapsed * 1000, " ".join(sql.split()), param_shape(params)
+        )
+
+class InstrumentedCursor:
+    """Cursor proxy that times every query and fetch."""
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, sql, params=None):
+        started = time.perf_counter()
+        try:
+            if params is None:
+                return self._cur.execute(sql)
+            return self._cur.execute(sql, params)
+        finally:
+            record_query(sql, params, time.perf_counter() - started)
+
+    def _fetch(self, fetch, *args):
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            record_timing("db", time.perf_counter() - started)
+
+    def fetchone(self):
+        return self._fetch(self._cur.fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(self._cur.fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(self._cur.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.timings = {"db": 0.0, "connect": 0.0, "write": 0.0, "render": 0.0}
+    g.query_count = 0
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    started = g.pop("render_started", None)
+    if started is not None:
+        record_timing("render", time.perf_counter() - started)
+
+@app.after_request
+def observe_request(resp):
+    if "request_started" not in g:
+        return resp
+    total = time.perf_counter() - g.request_started
+    route = request.url_rule.endpoint if request.url_rule else "unmatched"
+    REQUEST_HISTOGRAMS["total"].observe(route, total)
+    for kind, elapsed in g.timings.items():
+        REQUEST_HISTOGRAMS[kind].observe(route, elapsed)
+    REQUEST_HISTOGRAMS["queries"].observe(route, g.query_count)
+    metrics_store.start()
+
+    if SERVER_TIMING:
+        t = g.timings
+        resp.headers["Server-Timing"] = ", ".join([
+            f'db;dur={t["db"] * 1000:.2f};desc="{g.query_count} queries"',
+            f'connect;dur={t["connect"] * 1000:.2f}',
+            f'write;dur={t["write"] * 1000:.2f}',
+            f'render;dur={t["render"] * 1000:.2f}',
+            f'total;dur={total * 1000:.2f}',
+        ])
+    return resp
+
+# (name, type, help); values come from worker_snapshot()
+WORKER_METRICS = [
+    ("blip1t_slow_queries_total", "counter", f"Queries slower than {SLOW_QUERY_MS:g} ms."),
+    ("blip1t_db_pool_in_use", "gauge", "Connections checked out."),
+    ("blip1t_db_pool_idle", "gauge", "Connections idle in the pool."),
+    ("blip1t_db_pool_waits_total", "counter", "Checkouts that had to wait."),
+    ("blip1t_db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection."),
+    ("blip1t_db_pool_timeouts_total", "counter", "Checkouts that gave up."),
+    ("blip1t_write_queue_depth", "gauge", "Writes waiting for the next group commit."),
+    ("blip1t_write_batches_total", "counter", "Group commits."),
+    ("blip1t_write_jobs_total", "counter", "Writes committed or failed in group commits."),
+    ("blip1t_write_rejected_total", "counter", "Writes refused because the queue was full."),
+    ("blip1t_write_commit_seconds_total", "counter", "Time spent running group commits."),
+    ("blip1t_live_streams", "gauge", "Open live-update streams and long-polls."),
+]
+
+def worker_snapshot():
+    pool_stats, write_stats = pool.stats(), writes.stats()
+    return {
+        "histograms": {kind: histogram.snapshot() for kind, histogram in REQUEST_HISTOGRAMS.items()},
+        "metrics": {
+            "blip1t_slow_queries_total": slow_queries,
+            "blip1t_db_pool_in_use": pool_stats["in_use"],
+            "blip1t_db_pool_idle": pool_stats["idle"],
+            "blip1t_db_pool_waits_total": pool_stats["waits"],
+            "blip1t_db_pool_wait_seconds_total": pool_stats["wait_time"],
+            "blip1t_db_pool_timeouts_total": pool_stats["timeouts"],
+            "blip1t_write_queue_depth": write_stats["queued"],
+            "blip1t_write_batches_total": write_stats["batches"],
+            "blip1t_write_jobs_total": write_stats["jobs"],
+            "blip1t_write_rejected_total": write_stats["rejected"],
+            "blip1t_write_commit_seconds_total": write_stats["commit_time"],
+            "blip1t_live_streams": feed.streams,
+        },
+    }
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class MetricsStore:
+    """Worker metric snapshots in a SQLite file shared by the host's workers.
+
+    Each worker rewrites its row every METRICS_FLUSH_INTERVAL seconds and
+    /metrics sums the rows, so a scrape covers every worker no matter which
+    one answers it. Workers that have exited still count toward counters
+    and histograms but not gauges; rows left by an earlier server (another
+    parent process) are dropped.
+    """
 
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _db(self):
+        # Threads don't survive a fork; each worker opens its own connection
+        # and runs its own flusher
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    pid INTEGER PRIMARY KEY,
+                    parent INTEGER NOT NULL,
+                    data TEXT NOT NULL
+                )
+            """)
+            self._conn, self._pid = conn, os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+        return self._conn
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                app.logger.exception("metrics flush failed")
+
+    def start(self):
+        with self._lock:
+            self._db()
+
+    def flush(self):
+        data = json.dumps(worker_snapshot())
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM snapshots WHERE parent!=?", (os.getppid(),))
+            db.execute(
+                "INSERT OR REPLACE INTO snapshots (pid, parent, data) VALUES (?, ?, ?)",
+                (os.getpid(), os.getppid(), data)
+            )
+
+    def snapshots(self):
+        self.flush()
+        with self._lock:
+            rows = self._db().execute("SELECT pid, data FROM snapshots WHERE parent=?", (os.getppid(),)).fetchall()
+        return [(pid, json.loads(data)) for pid, data in rows]
+
+metrics_store = MetricsStore(METRICS_PATH)
+
+def render_metrics():
+    snapshots = metrics_store.snapshots()
+    lines = []
+    for kind, histogram in REQUEST_HISTOGRAMS.items():
+        merged = histogram.merge(snapshot["histograms"].get(kind, {}) for _, snapshot in snapshots)
+        lines.extend(histogram.render(merged))
+
+    alive = {pid for pid, _ in snapshots if process_alive(pid)}
+    for name, kind, help_text in WORKER_METRICS:
+        value = sum(
+            snapshot["metrics"].get(name, 0)
+            for pid, snapshot in snapshots
+            if kind == "counter" or pid in alive
+        )
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"])
+    return "\n".join(lines) + "\n"
+
+# -----------------------------
+# Schema migrations
+# -----------------------------
+def create_tables(cur):
     if USE_POSTGRES:
         cur.execute("""
             CREATE TABLE IF NOT EXISTS houses (
@@ -92,69 +570,868 @@ def init_db():
             )
         """)
 
-    db.commit()
-    cur.close()
-    db.close()
+def add_listing_indexes(cur):
+    # Composite so the keyset listings are pure index range scans
+    cur.execute("CREATE INDEX IF NOT EXISTS threads_house_id_idx ON threads (house_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS posts_thread_id_idx ON posts (thread_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS replies_post_id_idx ON replies (post_id, id)")
+
+def rebuild_thread_counters(cur):
+    # Counts are exact; activity times were never recorded before the
+    # counters existed, so threads without one start from "now"
+    cur.execute("""
+        UPDATE threads SET
+            post_count = (SELECT COUNT(*) FROM posts WHERE posts.thread_id = threads.id),
+            reply_count = (
+                SELECT COUNT(*) FROM replies
+                JOIN posts ON posts.id = replies.post_id
+                WHERE posts.thread_id = threads.id
+            ),
+            last_activity_at = COALESCE(last_activity_at, CURRENT_TIMESTAMP)
+    """)
+
+def add_thread_counters(cur):
+    cur.execute("ALTER TABLE threads ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE threads ADD COLUMN reply_count INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE threads ADD COLUMN last_activity_at TIMESTAMP")
+    rebuild_thread_counters(cur)
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS threads_house_bump_idx ON threads (house_id, last_activity_at, id)"
+    )
+
+SEARCH_LANGUAGE = "english"
+
+def create_search_index(cur):
+    # One row per searchable text: thread titles, posts and replies
+    if USE_POSTGRES:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS search_index (
+                kind TEXT NOT NULL,
+                ref_id INTEGER NOT NULL,
+                thread_id INTEGER NOT NULL REFERENCES threads(id),
+                body TEXT NOT NULL,
+                document TSVECTOR NOT NULL,
+                PRIMARY KEY (kind, ref_id)
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS search_index_document_idx ON search_index USING GIN (document)")
+    else:
+        cur.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+                body,
+                kind UNINDEXED,
+                ref_id UNINDEXED,
+                thread_id UNINDEXED,
+                tokenize = 'porter unicode61 remove_diacritics 2'
+            )
+        """)
+    reindex_search(cur)
+
+def reindex_search(cur):
+    cur.execute("DELETE FROM search_index")
+    if USE_POSTGRES:
+        lang = SEARCH_LANGUAGE
+        cur.execute(f"""
+            INSERT INTO search_index (kind, ref_id, thread_id, body, document)
+            SELECT 'thread', id, id, title, to_tsvector('{lang}', title) FROM threads
+            UNION ALL
+            SELECT 'post', id, thread_id, content, to_tsvector('{lang}', content) FROM posts
+            UNION ALL
+            SELECT 'reply', replies.id, posts.thread_id, replies.content, to_tsvector('{lang}', replies.content)
+            FROM replies JOIN posts ON posts.id = replies.post_id
+        """)
+    else:
+        cur.execute("""
+            INSERT INTO search_index (kind, ref_id, thread_id, body)
+            SELECT 'thread', id, id, title FROM threads
+            UNION ALL
+            SELECT 'post', id, thread_id, content FROM posts
+            UNION ALL
+            SELECT 'reply', replies.id, posts.thread_id, replies.content
+            FROM replies JOIN posts ON posts.id = replies.post_id
+        """)
+        cur.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+
+def create_page_generations(cur):
+    # Shared by every worker and host serving from this database
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS page_generations (
+            tag TEXT PRIMARY KEY,
+            gen INTEGER NOT NULL
+        )
+    """)
+
+# Applied in order; each version runs once and is recorded in schema_version
+MIGRATIONS = [
+    (1, create_tables),
+    (2, add_listing_indexes),
+    (3, add_thread_counters),
+    (4, create_search_index),
+    (5, create_page_generations),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+MIGRATION_LOCK_ID = 7262301
+
+def schema_version(db, cur):
+    try:
+        cur.execute("SELECT MAX(version) FROM schema_version")
+        return cur.fetchone()[0] or 0
+    except (sqlite3.OperationalError, psycopg2.errors.UndefinedTable):
+        db.rollback()
+        return 0
+
+def init_db():
+    db = connect_db()
+    cur = db.cursor()
+    try:
+        # Workers that start against an up-to-date schema only pay this check
+        if schema_version(db, cur) >= SCHEMA_VERSION:
+            return
+
+        # Serialize concurrently booting workers; re-read under the lock
+        if USE_POSTGRES:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+        else:
+            cur.execute("BEGIN IMMEDIATE")
+        cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY)")
+        current = schema_version(db, cur)
+
+        q = "%s" if USE_POSTGRES else "?"
+        for version, migrate in MIGRATIONS:
+            if version > current:
+                migrate(cur)
+                cur.execute(f"INSERT INTO schema_version (version) VALUES ({q})", (version,))
+        db.commit()
+    finally:
+        cur.close()
+        db.close()
 
 init_db()
 
 # -----------------------------
 # Helpers
 # -----------------------------
+POSTS_PER_PAGE = 50
+LISTING_LIMIT = 50
+LISTING_MAX_LIMIT = 200
+SEARCH_PER_PAGE = 20
+SEARCH_MAX_PAGE = 50
+
 def hash_tripcode(trip):
     return hashlib.sha256(trip.encode()).hexdigest()
 
+def fts5_query(terms):
+    # Quote every word so user input can't use (or break) FTS5 query syntax
+    return " ".join('"' + word.replace('"', '""') + '"' for word in terms.split())
+
+def page_args():
+    # ?before=<id>&limit=N for newest-first keyset listings
+    before = request.args.get("before", type=int)
+    limit = request.args.get("limit", LISTING_LIMIT, type=int)
+    return before, max(1, min(limit, LISTING_MAX_LIMIT))
+
+def index_document(cur, kind, ref_id, thread_id, body):
+    if USE_POSTGRES:
+        cur.execute(
+            "INSERT INTO search_index (kind, ref_id, thread_id, body, document) "
+            f"VALUES (%s, %s, %s, %s, to_tsvector('{SEARCH_LANGUAGE}', %s))",
+            (kind, ref_id, thread_id, body, body)
+        )
+    else:
+        cur.execute(
+            "INSERT INTO search_index (kind, ref_id, thread_id, body) VALUES (?, ?, ?, ?)",
+            (kind, ref_id, thread_id, body)
+        )
+
 def cursor(db):
     if USE_POSTGRES:
-        return db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    return db.cursor()
+        return InstrumentedCursor(db.cursor(cursor_factory=psycopg2.extras.DictCursor))
+    return InstrumentedCursor(db.cursor())
+
+# -----------------------------
+# Static assets
+# -----------------------------
+# Built by build_assets.py; without a build, templates fall back to /static
+ASSET_DIR = os.path.join(app.static_folder, "dist")
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+def load_asset_manifest():
+    try:
+        with open(os.path.join(ASSET_DIR, "manifest.json"), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}, "dev"
+    return json.loads(data), hashlib.sha1(data).hexdigest()[:10]
+
+asset_manifest, ASSET_VERSION = load_asset_manifest()
+
+def asset_url(name):
+    entry = asset_manifest.get(name)
+    return f"/assets/{entry['file']}" if entry else f"/static/{name}"
+
+def asset_webp(name):
+    entry = asset_manifest.get(name)
+    return f"/assets/{entry['webp']}" if entry and "webp" in entry else None
+
+@app.context_processor
+def asset_helpers():
+    return {"asset_url": asset_url, "asset_webp": asset_webp}
+
+# -----------------------------
+# Rendered page cache
+# -----------------------------
+# "memory" keeps pages per worker, "sqlite" in a file every worker on the
+# host shares, and "off" disables caching. Either way the generations live
+# in the app database, so a write on any host or worker invalidates pages
+# everywhere.
+PAGE_CACHE_BACKEND = os.environ.get("PAGE_CACHE_BACKEND", "sqlite")
+PAGE_CACHE_PATH = os.environ.get("PAGE_CACHE_PATH", "page_cache.db")
+PAGE_CACHE_MAX_BYTES = int(os.environ.get("PAGE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+PAGE_CACHE_MAX_AGE = int(os.environ.get("PAGE_CACHE_MAX_AGE", "300"))
+PAGE_CACHE_TOUCH_INTERVAL = 30
+
+def load_page_version():
+    # app.py, the templates and the asset build together decide what a page
+    # renders to, so a deploy that changes any of them starts fresh keys
+    digest = hashlib.sha1(ASSET_VERSION.encode())
+    paths = [os.path.abspath(__file__)]
+    for root, dirs, files in os.walk(app.template_folder):
+        paths.extend(os.path.join(root, name) for name in files)
+    for path in sorted(paths):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:10]
+
+PAGE_VERSION = load_page_version()
+
+# Pages are keyed by "<tag>@<generation>:<page version>:<path>". Writers
+# bump the tag's generation after committing, so a render that raced a
+# write is stored under a generation nobody asks for again and simply ages
+# out of the LRU. Entries are (body, etag, last_modified) and are served
+# for at most PAGE_CACHE_MAX_AGE seconds, which bounds how long a missed
+# invalidation can show.
+
+class MemoryPageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is not None:
+                self._pages.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._pages[key] = entry
+            self._bytes += len(entry[0])
+            while self._bytes > self.max_bytes and self._pages:
+                _, evicted = self._pages.popitem(last=False)
+                self._bytes -= len(evicted[0])
+
+class SQLitePageCache:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _db(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    key TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    etag TEXT NOT NULL,
+                    last_modified INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS pages_used_idx ON pages (used)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT body, etag, last_modified, used FROM pages WHERE key=?", (key,)
+            ).fetchone()
+            # Hits stay reads; recency only needs to be roughly right for eviction
+            now = time.time()
+            if row is not None and now - row[3] > PAGE_CACHE_TOUCH_INTERVAL:
+                db.execute("UPDATE pages SET used=? WHERE key=?", (now, key))
+        return tuple(row[:3]) if row else None
+
+    def set(self, key, entry):
+        body, etag, last_modified = entry
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO pages (key, body, etag, last_modified, size, used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, body, etag, last_modified, len(body), time.time())
+            )
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+            while total > self.max_bytes:
+                oldest = db.execute("SELECT key, size FROM pages ORDER BY used LIMIT 1").fetchone()
+                if oldest is None:
+                    break
+                db.execute("DELETE FROM pages WHERE key=?", (oldest[0],))
+                total -= oldest[1]
+
+def make_page_cache():
+    if PAGE_CACHE_BACKEND == "sqlite":
+        return SQLitePageCache(PAGE_CACHE_PATH, PAGE_CACHE_MAX_BYTES)
+    if PAGE_CACHE_BACKEND == "memory":
+        return MemoryPageCache(PAGE_CACHE_MAX_BYTES)
+    return None
+
+page_cache = make_page_cache()
+
+def page_generation(tag):
+    cur = cursor(get_db())
+    q = "%s" if USE_POSTGRES else "?"
+    cur.execute(f"SELECT gen FROM page_generations WHERE tag={q}", (tag,))
+    row = cur.fetchone()
+    cur.close()
+    return row[0] if row else 0
+
+def bump_page_generations(cur, tags):
+    q = "%s" if USE_POSTGRES else "?"
+    for tag in tags:
+        cur.execute(
+            f"INSERT INTO page_generations (tag, gen) VALUES ({q}, 1) "
+            f"ON CONFLICT (tag) DO UPDATE SET gen = page_generations.gen + 1",
+            (tag,)
+        )
+
+def invalidate_pages(*tags):
+    # Bumped even with caching off here: other hosts may still be caching
+    with pool.connection() as db:
+        cur = db.cursor()
+        bump_page_generations(cur, tags)
+        db.commit()
+        cur.close()
+
+def cached_page(tag):
+    """Serve the view from page_cache, keyed by its path and `tag`.
+
+    `tag` is formatted with the view arguments (e.g. "thread:{thread_id}");
+    invalidate_pages() with the same tag drops every cached variant of it.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            if page_cache is None:
+                return view(**kwargs)
+            page_tag = tag.format(**kwargs)
+            key = f"{page_tag}@{page_generation(page_tag)}:{PAGE_VERSION}:{request.full_path}"
+            entry = page_cache.get(key)
+            if entry is None or time.time() - entry[2] > PAGE_CACHE_MAX_AGE:
+                rv = view(**kwargs)
+                if not isinstance(rv, str):
+                    return rv
+                body = rv.encode()
+                entry = (body, hashlib.sha1(body).hexdigest(), int(time.time()))
+                page_cache.set(key, entry)
+
+            body, etag, last_modified = entry
+            resp = Response(body, mimetype="text/html")
+            resp.set_etag(etag)
+            resp.last_modified = last_modified
+            # Let browsers and proxies keep it, but revalidate every time
+            resp.cache_control.no_cache = True
+            return resp.make_conditional(request)
+        return wrapper
+    return decorator
+
+# -----------------------------
+# Write pipeline (group commit)
+# -----------------------------
+WRITE_BATCH_WINDOW = float(os.environ.get("WRITE_BATCH_WINDOW_MS", "2")) / 1000
+WRITE_BATCH_MAX = int(os.environ.get("WRITE_BATCH_MAX", "64"))
+WRITE_QUEUE_SIZE = int(os.environ.get("WRITE_QUEUE_SIZE", "256"))
+WRITE_TIMEOUT = float(os.environ.get("WRITE_TIMEOUT", "10"))
+
+class WriteTimeout(Exception):
+    pass
+
+class WritePipeline:
+    """Runs submitted writes on one connection, committing them in groups.
+
+    The writer thread takes the first queued job, keeps collecting for up to
+    `window` seconds or `max_batch` jobs, runs each under its own savepoint
+    and commits the group once. A job that raises only rolls back itself.
+    submit() blocks while the queue is full and gives up with WriteTimeout;
+    a job that times out in the queue is withdrawn, so a retry can't
+    duplicate it.
+    """
+
+    def __init__(self, connect, window, max_batch, queue_size):
+        self.connect = connect
+        self.window = window
+        self.max_batch = max_batch
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self.batches = 0
+        self.jobs = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_batch_size = 0
+        self.commit_time = 0.0
+        self.max_commit_time = 0.0
+
+    def _start(self):
+        with self._lock:
+            # Threads don't survive a fork; each worker runs its own writer
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.queue_size)
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, args=(self._queue,), daemon=True).start()
+        return self._queue
+
+    def submit(self, job, timeout=WRITE_TIMEOUT):
+        """Run job(cur) in the next group commit and return its result."""
+        future = Future()
+        started = time.perf_counter()
+        # One budget for queueing and committing, not `timeout` for each
+        deadline = time.monotonic() + timeout
+        try:
+            self._start().put((job, future), timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise WriteTimeout("write queue is full")
+        try:
+            return future.result(max(deadline - time.monotonic(), 0))
+        except FutureTimeout:
+            # Only report a retryable failure if the job can no longer run;
+            # once the writer has picked it up, its outcome is what we return
+            if future.cancel():
+                raise WriteTimeout(f"write not committed after {timeout}s")
+            return future.result()
+        finally:
+            record_timing("write", time.perf_counter() - started)
+
+    def _run(self, jobs):
+        conn = None
+        while True:
+            batch = [jobs.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(jobs.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            # Drop jobs whose submitter gave up; the rest can no longer be cancelled
+            batch = [(job, future) for job, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                if conn is None:
+                    conn = self.connect()
+                self._commit(conn, batch)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                conn = None
+
+    def _commit(self, conn, batch):
+        started = time.monotonic()
+        cur = InstrumentedCursor(conn.cursor())
+        if not USE_POSTGRES:
+            # Take the write lock up front instead of upgrading mid-batch
+            cur.execute("BEGIN IMMEDIATE")
+        outcomes = []
+        for job, future in batch:
+            cur.execute("SAVEPOINT write_job")
+            try:
+                outcomes.append((future, job(cur), None))
+            except Exception as e:
+                cur.execute("ROLLBACK TO SAVEPOINT write_job")
+                outcomes.append((future, None, e))
+            cur.execute("RELEASE SAVEPOINT write_job")
+        conn.commit()
+        cur.close()
+        elapsed = time.monotonic() - started
+
+        with self._lock:
+            self.batches += 1
+            self.jobs += len(batch)
+            self.failed += sum(1 for _, _, error in outcomes if error is not None)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.commit_time += elapsed
+            self.max_commit_time = max(self.max_commit_time, elapsed)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize() if self._queue else 0,
+                "batches": self.batches,
+                "jobs": self.jobs,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "avg_batch_size": round(self.jobs / self.batches, 2) if self.batches else 0,
+                "max_batch_size": self.max_batch_size,
+                "commit_time": round(self.commit_time, 6),
+                "avg_commit_time": round(self.commit_time / self.batches, 6) if self.batches else 0,
+                "max_commit_time": round(self.max_commit_time, 6),
+            }
+
+writes = WritePipeline(connect_db, WRITE_BATCH_WINDOW, WRITE_BATCH_MAX, WRITE_QUEUE_SIZE)
+
+def create_thread(cur, house_id, title, nickname, trip_hash, content):
+    if USE_POSTGRES:
+        cur.execute(
+            "INSERT INTO threads (house_id, title, post_count, last_activity_at) "
+            "VALUES (%s, %s, 1, CURRENT_TIMESTAMP) RETURNING id",
+            (house_id, title)
+        )
+        thread_id = cur.fetchone()[0]
+        cur.execute(
+            "INSERT INTO posts (thread_id, nickname, tripcode_hash, content) VALUES (%s, %s, %s, %s) RETURNING id",
+            (thread_id, nickname, trip_hash, content)
+        )
+        post_id = cur.fetchone()[0]
+    else:
+        cur.execute(
+            "INSERT INTO threads (house_id, title, post_count, last_activity_at) "
+            "VALUES (?, ?, 1, CURRENT_TIMESTAMP)",
+            (house_id, title)
+        )
+        thread_id = cur.lastrowid
+        cur.execute(
+            "INSERT INTO posts (thread_id, nickname, tripcode_hash, content) VALUES (?, ?, ?, ?)",
+            (thread_id, nickname, trip_hash, content)
+        )
+        post_id = cur.lastrowid
+
+    index_document(cur, "thread", thread_id, thread_id, title)
+    index_document(cur, "post", post_id, thread_id, content)
+    return thread_id
+
+def add_reply(cur, post_id, nickname, trip_hash, content):
+    q = "%s" if USE_POSTGRES else "?"
+    # Bumping the thread first also tells us where the reply lands
+    cur.execute(
+        "UPDATE threads SET reply_count = reply_count + 1, last_activity_at = CURRENT_TIMESTAMP "
+        f"WHERE id = (SELECT thread_id FROM posts WHERE id={q}) RETURNING id, house_id",
+        (post_id,)
+    )
+    row = cur.fetchone()
+    if row is None:
+        raise LookupError(f"post {post_id} does not exist")
+    thread_id, house_id = row
+
+    if USE_POSTGRES:
+        cur.execute(
+            "INSERT INTO replies (post_id, nickname, tripcode_hash, content) VALUES (%s, %s, %s, %s) RETURNING id",
+            (post_id, nickname, trip_hash, content)
+        )
+        reply_id = cur.fetchone()[0]
+    else:
+        cur.execute(
+            "INSERT INTO replies (post_id, nickname, tripcode_hash, content) VALUES (?, ?, ?, ?)",
+            (post_id, nickname, trip_hash, content)
+        )
+        reply_id = cur.lastrowid
+    index_document(cur, "reply", reply_id, thread_id, content)
+    if USE_POSTGRES:
+        # Delivered to every worker's change feed when the batch commits
+        cur.execute("SELECT pg_notify(%s, %s)", (FEED_CHANNEL, str(thread_id)))
+    return thread_id, house_id
+
+# -----------------------------
+# Live thread updates
+# -----------------------------
+FEED_CHANNEL = "thread_activity"
+LIVE_POLL_INTERVAL = float(os.environ.get("LIVE_POLL_INTERVAL", "0.5"))
+LIVE_MAX_STREAMS = int(os.environ.get("LIVE_MAX_STREAMS", "16"))
+LIVE_STREAM_SECONDS = 300
+LIVE_KEEPALIVE_SECONDS = 15
+LIVE_LONG_POLL_SECONDS = 25
+LIVE_DELTA_LIMIT = 200
+
+class ChangeFeed:
+    """Per-worker record of which threads got new posts or replies.
+
+    One background thread per worker follows the database: LISTEN on
+    Postgres, where add_reply() NOTIFYs on commit, or a tail of the max
+    post/reply ids on SQLite. Each change bumps a per-thread version that
+    live viewers wait on, so every worker sees writes made by any other.
+    """
+
+    def __init__(self, connect, poll_interval, max_streams):
+        self.connect = connect
+        self.poll_interval = poll_interval
+        self.max_streams = max_streams
+        self._cond = threading.Condition()
+        self._pid = None
+        self._versions = {}
+        self.streams = 0
+
+    def _start(self):
+        with self._cond:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._versions = {}
+                self.streams = 0
+                threading.Thread(target=self._follow, daemon=True).start()
+
+    def version(self, thread_id):
+        self._start()
+        with self._cond:
+            return self._versions.get(thread_id, 0)
+
+    def wait(self, thread_id, version, timeout):
+        """Block until thread_id moves past `version`; False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._versions.get(thread_id, 0) == version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def enter_stream(self):
+        # Every open stream pins a worker thread, so cap them
+        self._start()
+        with self._cond:
+            if self.streams >= self.max_streams:
+                return False
+            self.streams += 1
+            return True
+
+    def leave_stream(self):
+        with self._cond:
+            self.streams -= 1
+
+    def _publish(self, thread_ids):
+        with self._cond:
+            for thread_id in thread_ids:
+                self._versions[thread_id] = self._versions.get(thread_id, 0) + 1
+            self._cond.notify_all()
+
+    def _follow(self):
+        while True:
+            try:
+                if USE_POSTGRES:
+                    self._listen()
+                else:
+                    self._tail()
+            except Exception:
+                app.logger.exception("change feed lost its connection, reconnecting")
+                time.sleep(1)
+
+    def _listen(self):
+        conn = self.connect()
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {FEED_CHANNEL}")
+            while True:
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                thread_ids = {int(n.payload) for n in conn.notifies}
+                conn.notifies.clear()
+                if thread_ids:
+                    self._publish(thread_ids)
+        finally:
+            conn.close()
+
+    def _tail(self):
+        conn = self.connect()
+        try:
+            max_ids = "SELECT (SELECT COALESCE(MAX(id), 0) FROM posts), (SELECT COALESCE(MAX(id), 0) FROM replies)"
+            last_post, last_reply = conn.execute(max_ids).fetchone()
+            while True:
+                time.sleep(self.poll_interval)
+                post_id, reply_id = conn.execute(max_ids).fetchone()
+                if (post_id, reply_id) == (last_post, last_reply):
+                    continue
+                rows = conn.execute("""
+                    SELECT thread_id FROM posts WHERE id > ? AND id <= ?
+                    UNION
+                    SELECT posts.thread_id FROM replies JOIN posts ON posts.id = replies.post_id
+                    WHERE replies.id > ? AND replies.id <= ?
+                """, (last_post, post_id, last_reply, reply_id)).fetchall()
+                self._publish({row[0] for row in rows})
+                last_post, last_reply = post_id, reply_id
+        finally:
+            conn.close()
+
+feed = ChangeFeed(connect_db, LIVE_POLL_INTERVAL, LIVE_MAX_STREAMS)
+
+def parse_live_cursor(value):
+    # "<last post id>-<last reply id>", also used as the SSE event id
+    try:
+        post_id, reply_id = (int(part) for part in value.split("-"))
+    except (AttributeError, ValueError):
+        return None
+    return post_id, reply_id
+
+def thread_delta(thread_id, after_post, after_reply):
+    q = "%s" if USE_POSTGRES else "?"
+    with pool.connection() as db:
+        cur = cursor(db)
+        cur.execute(
+            f"SELECT id, nickname, tripcode_hash, content FROM posts "
+            f"WHERE thread_id={q} AND id>{q} ORDER BY id ASC LIMIT {q}",
+            (thread_id, after_post, LIVE_DELTA_LIMIT)
+        )
+        posts = cur.fetchall()
+        cur.execute(
+            f"SELECT replies.id, replies.post_id, replies.nickname, replies.tripcode_hash, replies.content "
+            f"FROM replies JOIN posts ON posts.id = replies.post_id "
+            f"WHERE posts.thread_id={q} AND replies.id>{q} ORDER BY replies.id ASC LIMIT {q}",
+            (thread_id, after_reply, LIVE_DELTA_LIMIT)
+        )
+        replies = cur.fetchall()
+        cur.close()
+
+    def public(row):
+        item = dict(row)
+        item["tripcode"] = item.pop("tripcode_hash")[:8]
+        return item
+
+    next_cursor = (
+        posts[-1]["id"] if posts else after_post,
+        replies[-1]["id"] if replies else after_reply,
+    )
+    return [public(p) for p in posts], [public(r) for r in replies], next_cursor
+
+def live_stream(thread_id, live_cursor):
+    yield "retry: 3000\n\n"
+    deadline = time.monotonic() + LIVE_STREAM_SECONDS
+    while time.monotonic() < deadline:
+        # Read the version first so a write during the query still wakes us
+        version = feed.version(thread_id)
+        posts, replies, live_cursor = thread_delta(thread_id, *live_cursor)
+        if posts or replies:
+            data = json.dumps({"posts": posts, "replies": replies})
+            yield f"id: {live_cursor[0]}-{live_cursor[1]}\nevent: delta\ndata: {data}\n\n"
+            continue
+        if not feed.wait(thread_id, version, LIVE_KEEPALIVE_SECONDS):
+            yield ": keepalive\n\n"
 
 # -----------------------------
 # Routes
 # -----------------------------
+@app.errorhandler(PoolTimeout)
+@app.errorhandler(WriteTimeout)
+def server_busy(e):
+    return "Server busy, try again in a moment.", 503
+
 @app.route("/")
+@cached_page("houses")
 def index():
+    before, limit = page_args()
     db = get_db()
     cur = cursor(db)
-    cur.execute("SELECT * FROM houses ORDER BY id DESC")
+    q = "%s" if USE_POSTGRES else "?"
+    if before is None:
+        cur.execute(f"SELECT * FROM houses ORDER BY id DESC LIMIT {q}", (limit + 1,))
+    else:
+        cur.execute(f"SELECT * FROM houses WHERE id<{q} ORDER BY id DESC LIMIT {q}", (before, limit + 1))
     houses = cur.fetchall()
     cur.close()
-    db.close()
-    return render_template("index.html", houses=houses)
+    next_before = houses[limit - 1]["id"] if len(houses) > limit else None
+    return render_template("index.html", houses=houses[:limit], limit=limit, next_before=next_before)
 
 @app.route("/house/new", methods=["GET", "POST"])
 def new_house():
     if request.method == "POST":
         name = request.form["name"]
         db = get_db()
-        cur = db.cursor()
+        cur = cursor(db)
         try:
             if USE_POSTGRES:
                 cur.execute("INSERT INTO houses (name) VALUES (%s)", (name,))
             else:
                 cur.execute("INSERT INTO houses (name) VALUES (?)", (name,))
             db.commit()
+            invalidate_pages("houses")
             return redirect("/")
         except Exception:
             db.rollback()
             return "House name already taken!"
         finally:
             cur.close()
-            db.close()
     return render_template("new_house.html")
 
 @app.route("/house/<int:house_id>")
+@cached_page("house:{house_id}")
 def house(house_id):
+    before, limit = page_args()
     db = get_db()
     cur = cursor(db)
     q = "%s" if USE_POSTGRES else "?"
     cur.execute(f"SELECT * FROM houses WHERE id={q}", (house_id,))
     house = cur.fetchone()
-    cur.execute(f"SELECT * FROM threads WHERE house_id={q} ORDER BY id DESC", (house_id,))
+    if house is None:
+        abort(404)
+    sort = "bump" if request.args.get("sort") == "bump" else "new"
+    if sort == "bump":
+        # Keyset on (last_activity_at, id); the cursor carries both values so
+        # a bump to the anchor thread between page loads can't move the page
+        before_ts = request.args.get("before_ts")
+        order = "ORDER BY last_activity_at DESC, id DESC"
+        after_cursor = f"(last_activity_at, id) < ({q}, {q})"
+        cursor_args = (before_ts, before)
+        if before_ts is None:
+            before = None
+    else:
+        order = "ORDER BY id DESC"
+        after_cursor = f"id<{q}"
+        cursor_args = (before,)
+    if before is None:
+        cur.execute(
+            f"SELECT * FROM threads WHERE house_id={q} {order} LIMIT {q}",
+            (house_id, limit + 1)
+        )
+    else:
+        cur.execute(
+            f"SELECT * FROM threads WHERE house_id={q} AND {after_cursor} {order} LIMIT {q}",
+            (house_id, *cursor_args, limit + 1)
+        )
     threads = cur.fetchall()
     cur.close()
-    db.close()
-    return render_template("house.html", house=house, threads=threads)
+    next_before = next_before_ts = None
+    if len(threads) > limit:
+        next_before = threads[limit - 1]["id"]
+        next_before_ts = str(threads[limit - 1]["last_activity_at"])
+    return render_template(
+        "house.html", house=house, threads=threads[:limit], limit=limit,
+        next_before=next_before, next_before_ts=next_before_ts, sort=sort
+    )
 
 @app.route("/house/<int:house_id>/thread/new", methods=["GET", "POST"])
 def new_thread(house_id):
@@ -165,59 +1442,103 @@ def new_thread(house_id):
         content = request.form["content"]
         trip_hash = hash_tripcode(tripcode)
 
-        db = get_db()
-        cur = db.cursor()
-
-        if USE_POSTGRES:
-            cur.execute(
-                "INSERT INTO threads (house_id, title) VALUES (%s, %s) RETURNING id",
-                (house_id, title)
-            )
-            thread_id = cur.fetchone()[0]
-            cur.execute(
-                "INSERT INTO posts (thread_id, nickname, tripcode_hash, content) VALUES (%s, %s, %s, %s)",
-                (thread_id, nickname, trip_hash, content)
-            )
-        else:
-            cur.execute(
-                "INSERT INTO threads (house_id, title) VALUES (?, ?)",
-                (house_id, title)
-            )
-            thread_id = cur.lastrowid
-            cur.execute(
-                "INSERT INTO posts (thread_id, nickname, tripcode_hash, content) VALUES (?, ?, ?, ?)",
-                (thread_id, nickname, trip_hash, content)
-            )
-
-        db.commit()
-        cur.close()
-        db.close()
+        thread_id = writes.submit(
+            lambda cur: create_thread(cur, house_id, title, nickname, trip_hash, content)
+        )
+        invalidate_pages(f"house:{house_id}")
         return redirect(f"/thread/{thread_id}")
 
     return render_template("new_thread.html", house_id=house_id)
 
 @app.route("/thread/<int:thread_id>")
+@cached_page("thread:{thread_id}")
 def thread(thread_id):
+    after = request.args.get("after", 0, type=int)
     db = get_db()
     cur = cursor(db)
     q = "%s" if USE_POSTGRES else "?"
 
     cur.execute(f"SELECT * FROM threads WHERE id={q}", (thread_id,))
     thread = cur.fetchone()
+    if thread is None:
+        abort(404)
+
+    # Live updates resume from here; taken before the page so nothing is
+    # missed, and the client drops anything it already shows
+    cur.execute("SELECT (SELECT COALESCE(MAX(id), 0) FROM posts), (SELECT COALESCE(MAX(id), 0) FROM replies)")
+    live_cursor = "{}-{}".format(*cur.fetchone())
 
-    cur.execute(f"SELECT * FROM posts WHERE thread_id={q} ORDER BY id ASC", (thread_id,))
+    # Keyset page over posts; the extra row only tells us there is more
+    cur.execute(
+        f"SELECT * FROM posts WHERE thread_id={q} AND id>{q} ORDER BY id ASC LIMIT {q}",
+        (thread_id, after, POSTS_PER_PAGE + 1)
+    )
     posts_rows = cur.fetchall()
+    has_more = len(posts_rows) > POSTS_PER_PAGE
+    posts_rows = posts_rows[:POSTS_PER_PAGE]
 
-    posts = []
-    for p in posts_rows:
-        post = dict(p)
-        cur.execute(f"SELECT * FROM replies WHERE post_id={q} ORDER BY id ASC", (p["id"],))
-        post["replies"] = cur.fetchall()
-        posts.append(post)
+    posts = [dict(p, replies=[]) for p in posts_rows]
+    if posts:
+        by_id = {p["id"]: p for p in posts}
+        marks = ", ".join([q] * len(posts))
+        cur.execute(
+            f"SELECT * FROM replies WHERE post_id IN ({marks}) ORDER BY id ASC",
+            tuple(by_id)
+        )
+        for r in cur.fetchall():
+            by_id[r["post_id"]]["replies"].append(r)
 
     cur.close()
-    db.close()
-    return render_template("thread.html", thread=thread, posts=posts)
+    next_after = posts[-1]["id"] if has_more else None
+    return render_template(
+        "thread.html", thread=thread, posts=posts, after=after, next_after=next_after, live_cursor=live_cursor
+    )
+
+@app.route("/thread/<int:thread_id>/events")
+def thread_events(thread_id):
+    # Server-Sent Events by default; ?poll=1 is a JSON long-poll fallback
+    live_cursor = parse_live_cursor(request.headers.get("Last-Event-ID") or request.args.get("after"))
+    if live_cursor is None:
+        return "Missing or malformed ?after=<post id>-<reply id>", 400
+
+    # Not get_db(): a long-poll must not hold a request connection while it
+    # waits, and thread_delta() checks out its own for each read
+    q = "%s" if USE_POSTGRES else "?"
+    with pool.connection() as db:
+        cur = cursor(db)
+        cur.execute(f"SELECT id FROM threads WHERE id={q}", (thread_id,))
+        exists = cur.fetchone() is not None
+        cur.close()
+    if not exists:
+        abort(404)
+
+    if request.args.get("poll"):
+        # Over the stream cap a long-poll degrades to a plain poll
+        waiting = feed.enter_stream()
+        try:
+            deadline = time.monotonic() + LIVE_LONG_POLL_SECONDS
+            while True:
+                version = feed.version(thread_id)
+                posts, replies, next_cursor = thread_delta(thread_id, *live_cursor)
+                remaining = deadline - time.monotonic()
+                if posts or replies or not waiting or remaining <= 0:
+                    break
+                feed.wait(thread_id, version, remaining)
+        finally:
+            if waiting:
+                feed.leave_stream()
+        return jsonify(cursor="{}-{}".format(*next_cursor), posts=posts, replies=replies)
+
+    if not feed.enter_stream():
+        return "Too many live viewers right now.", 503
+    resp = Response(
+        live_stream(thread_id, live_cursor),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # The server closes the response even if the body is never iterated (HEAD)
+    resp.call_on_close(feed.leave_stream)
+    return resp
 
 @app.route("/post/<int:post_id>/reply", methods=["POST"])
 def reply(post_id):
@@ -226,22 +1547,107 @@ def reply(post_id):
     content = request.form["content"]
     trip_hash = hash_tripcode(tripcode)
 
-    db = get_db()
-    cur = db.cursor()
-    q = "%s" if USE_POSTGRES else "?"
+    try:
+        thread_id, house_id = writes.submit(
+            lambda cur: add_reply(cur, post_id, nickname, trip_hash, content)
+        )
+    except LookupError:
+        abort(404)
+    invalidate_pages(f"thread:{thread_id}", f"house:{house_id}")
+    return redirect(f"/thread/{thread_id}")
 
-    cur.execute(
-        f"INSERT INTO replies (post_id, nickname, tripcode_hash, content) VALUES ({q}, {q}, {q}, {q})",
-        (post_id, nickname, trip_hash, content)
+@app.route("/search")
+def search():
+    terms = request.args.get("q", "").strip()
+    page = max(1, min(request.args.get("page", 1, type=int), SEARCH_MAX_PAGE))
+    results = []
+    if terms:
+        db = get_db()
+        cur = cursor(db)
+        if USE_POSTGRES:
+            cur.execute(f"""
+                SELECT s.kind, s.thread_id, s.body, t.title FROM (
+                    SELECT kind, thread_id, body, ts_rank(document, query) AS score
+                    FROM search_index, websearch_to_tsquery('{SEARCH_LANGUAGE}', %s) AS query
+                    WHERE document @@ query
+                    ORDER BY score DESC
+                    LIMIT %s OFFSET %s
+                ) s JOIN threads t ON t.id = s.thread_id
+                ORDER BY s.score DESC
+            """, (terms, SEARCH_PER_PAGE + 1, (page - 1) * SEARCH_PER_PAGE))
+        else:
+            cur.execute("""
+                SELECT s.kind, s.thread_id, s.body, t.title FROM (
+                    SELECT kind, thread_id, body, bm25(search_index) AS score
+                    FROM search_index
+                    WHERE search_index MATCH ?
+                    ORDER BY score
+                    LIMIT ? OFFSET ?
+                ) s JOIN threads t ON t.id = s.thread_id
+                ORDER BY s.score
+            """, (fts5_query(terms), SEARCH_PER_PAGE + 1, (page - 1) * SEARCH_PER_PAGE))
+        results = cur.fetchall()
+        cur.close()
+    has_more = len(results) > SEARCH_PER_PAGE and page < SEARCH_MAX_PAGE
+    return render_template(
+        "search.html", terms=terms, results=results[:SEARCH_PER_PAGE], page=page, has_more=has_more
     )
-    db.commit()
 
-    cur.execute(f"SELECT thread_id FROM posts WHERE id={q}", (post_id,))
-    thread_id = cur.fetchone()[0]
+@app.route("/assets/<path:filename>")
+def asset(filename):
+    # Names are content-hashed, so a response never goes stale
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        path = safe_join(ASSET_DIR, filename + suffix)
+        if request.accept_encodings[encoding] and path and os.path.isfile(path):
+            resp = send_from_directory(ASSET_DIR, filename + suffix, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+            resp.content_encoding = encoding
+            break
+    else:
+        resp = send_from_directory(ASSET_DIR, filename, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    resp.vary.add("Accept-Encoding")
+    resp.cache_control.immutable = True
+    return resp
+
+@app.route("/stats/pool")
+def pool_stats():
+    return jsonify(pool.stats())
 
+@app.route("/stats/writes")
+def write_stats():
+    return jsonify(writes.stats())
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+# -----------------------------
+# Commands
+# -----------------------------
+@app.cli.command("rebuild-counters")
+def rebuild_counters_command():
+    """Recompute thread post/reply counts from the posts and replies tables."""
+    db = connect_db()
+    cur = db.cursor()
+    rebuild_thread_counters(cur)
+    # House pages show the counts; drop them in the same transaction
+    cur.execute("SELECT id FROM houses")
+    bump_page_generations(cur, [f"house:{row[0]}" for row in cur.fetchall()])
+    db.commit()
     cur.close()
     db.close()
-    return redirect(f"/thread/{thread_id}")
+    print("Thread counters rebuilt.")
+
+@app.cli.command("reindex-search")
+def reindex_search_command():
+    """Rebuild the full-text search index from threads, posts and replies."""
+    db = connect_db()
+    cur = db.cursor()
+    reindex_search(cur)
+    db.commit()
+    cur.close()
+    db.close()
+    print("Search index rebuilt.")
 
 if __name__ == "__main__":
     app.run(debug=True)
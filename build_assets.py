@@ -0,0 +1,130 @@
+"""Build fingerprinted static assets into static/dist.
+
+    python build_assets.py
+
+Deploys run this from bin/post_compile, so the slug ships with the build.
+Every file in static/ is copied to static/dist/ under a content-hashed
+name (logo.png -> logo.3f2a9c1b0d.png) and listed in
+static/dist/manifest.json, which app.asset_url() reads. Text assets also
+get .gz (and .br, with the brotli package) siblings, and images get a
+WebP variant when Pillow is installed and the result is smaller. CSS
+url() references are rewritten to the hashed names. Old builds are kept
+so pages cached before a deploy still find their assets.
+"""
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+
+try:
+    from PIL import Image
+except ImportError:  # no WebP variants without Pillow
+    Image = None
+
+try:
+    import brotli
+except ImportError:  # gzip only without brotli
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+URL_PREFIX = "/assets/"
+
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt"}
+WEBP_SOURCES = {".png", ".jpg", ".jpeg"}
+WEBP_QUALITY = 80
+
+CSS_BACKGROUND = re.compile(r"background-image:\s*url\(['\"]?/static/([^'\")]+)['\"]?\)\s*;")
+CSS_URL = re.compile(r"url\(['\"]?/static/([^'\")]+)['\"]?\)")
+
+
+def fingerprint(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+
+
+def write(name, data):
+    path = os.path.join(DIST_DIR, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+    if os.path.splitext(name)[1] in COMPRESSIBLE:
+        with open(path + ".gz", "wb") as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(path + ".br", "wb") as f:
+                f.write(brotli.compress(data, quality=11))
+
+
+def webp_variant(data):
+    if Image is None:
+        return None
+    out = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as img:
+        img.save(out, "WEBP", quality=WEBP_QUALITY, method=6)
+    webp = out.getvalue()
+    return webp if len(webp) < len(data) else None
+
+
+def rewrite_css(css, manifest):
+    def background(match):
+        entry = manifest.get(match.group(1))
+        if entry is None or "webp" not in entry:
+            return match.group(0)
+        # Plain url() first for browsers without image-set()
+        fallback = URL_PREFIX + entry["file"]
+        fallback_type = mimetypes.guess_type(match.group(1))[0]
+        return (
+            f"background-image: url('{fallback}');\n"
+            f"  background-image: image-set(url('{URL_PREFIX + entry['webp']}') type('image/webp'), "
+            f"url('{fallback}') type('{fallback_type}'));"
+        )
+
+    def url(match):
+        entry = manifest.get(match.group(1))
+        return f"url('{URL_PREFIX + entry['file']}')" if entry else match.group(0)
+
+    return CSS_URL.sub(url, CSS_BACKGROUND.sub(background, css))
+
+
+def build():
+    sources = []
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != DIST_DIR]
+        for filename in files:
+            path = os.path.join(root, filename)
+            sources.append(os.path.relpath(path, STATIC_DIR).replace(os.sep, "/"))
+
+    # Stylesheets last, so their url()s can point at the hashed images
+    sources.sort(key=lambda name: (name.endswith(".css"), name))
+
+    manifest = {}
+    for name in sources:
+        with open(os.path.join(STATIC_DIR, name), "rb") as f:
+            data = f.read()
+        ext = os.path.splitext(name)[1]
+
+        if ext == ".css":
+            data = rewrite_css(data.decode(), manifest).encode()
+        entry = {"file": fingerprint(name, data)}
+        write(entry["file"], data)
+
+        if ext in WEBP_SOURCES:
+            webp = webp_variant(data)
+            if webp is not None:
+                entry["webp"] = fingerprint(os.path.splitext(name)[0] + ".webp", webp)
+                write(entry["webp"], webp)
+
+        manifest[name] = entry
+        print(f"{name} -> {', '.join(entry.values())}")
+
+    with open(os.path.join(DIST_DIR, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    build()